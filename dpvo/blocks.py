@@ -39,8 +39,15 @@ class SoftAgg(nn.Module):
 
     def forward(self, x, ix):
         _, jx = torch.unique(ix, return_inverse=True)
-        w = torch_scatter.scatter_softmax(self.g(x), jx, dim=1)
-        y = torch_scatter.scatter_sum(self.f(x) * w, jx, dim=1)
+
+        g, f = self.g(x), self.f(x)
+
+        # torch_scatter has no bfloat16 dispatch, fp16 inference scatters as is
+        if g.dtype == torch.bfloat16:
+            g, f = g.float(), f.float()
+
+        w = torch_scatter.scatter_softmax(g, jx, dim=1)
+        y = torch_scatter.scatter_sum(f * w, jx, dim=1)
 
         if self.expand:
             return self.h(y)[:,jx]
@@ -58,8 +65,15 @@ class SoftAggBasic(nn.Module):
 
     def forward(self, x, ix):
         _, jx = torch.unique(ix, return_inverse=True)
-        w = torch_scatter.scatter_softmax(self.g(x), jx, dim=1)
-        y = torch_scatter.scatter_sum(self.f(x) * w, jx, dim=1)
+
+        g, f = self.g(x), self.f(x)
+
+        # torch_scatter has no bfloat16 dispatch, fp16 inference scatters as is
+        if g.dtype == torch.bfloat16:
+            g, f = g.float(), f.float()
+
+        w = torch_scatter.scatter_softmax(g, jx, dim=1)
+        y = torch_scatter.scatter_sum(f * w, jx, dim=1)
 
         if self.expand:
             return self.h(y)[:,jx]
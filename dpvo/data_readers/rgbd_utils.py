@@ -118,7 +118,7 @@ def compute_distance_matrix_flow(poses, disps, intrinsics):
 
     N = poses.shape[1]
 
-    ii, jj = torch.meshgrid(torch.arange(N), torch.arange(N))
+    ii, jj = torch.meshgrid(torch.arange(N), torch.arange(N), indexing="ij")
     ii = ii.reshape(-1).cuda()
     jj = jj.reshape(-1).cuda()
 
@@ -127,17 +127,20 @@ def compute_distance_matrix_flow(poses, disps, intrinsics):
 
     s = 2048
     for i in range(0, ii.shape[0], s):
+        # the reverse direction only needs the inverse relative pose
+        Gij = poses[:, jj[i : i + s]] * poses[:, ii[i : i + s]].inv()
+
         flow1, val1 = pops.induced_flow(
-            poses, disps, intrinsics, ii[i : i + s], jj[i : i + s]
+            poses, disps, intrinsics, ii[i : i + s], jj[i : i + s], Gij
         )
         flow2, val2 = pops.induced_flow(
-            poses, disps, intrinsics, jj[i : i + s], ii[i : i + s]
+            poses, disps, intrinsics, jj[i : i + s], ii[i : i + s], Gij.inv()
         )
 
         flow = torch.stack([flow1, flow2], dim=2)
         val = torch.stack([val1, val2], dim=2)
 
-        mag = flow.norm(dim=-1).clamp(max=MAX_FLOW)
+        mag = torch.linalg.vector_norm(flow, dim=-1).clamp(max=MAX_FLOW)
         mag = mag.view(mag.shape[1], -1)
         val = val.view(val.shape[1], -1)
 
@@ -162,7 +165,7 @@ def compute_distance_matrix_flow2(poses, disps, intrinsics, beta=0.4):
 
     N = poses.shape[1]
 
-    ii, jj = torch.meshgrid(torch.arange(N), torch.arange(N))
+    ii, jj = torch.meshgrid(torch.arange(N), torch.arange(N), indexing="ij")
     ii = ii.reshape(-1)
     jj = jj.reshape(-1)
 
@@ -193,7 +196,7 @@ def compute_distance_matrix_flow2(poses, disps, intrinsics, beta=0.4):
         flow = torch.stack([flow1, flow2], dim=2)
         val = torch.stack([val1, val2], dim=2)
 
-        mag = flow.norm(dim=-1).clamp(max=MAX_FLOW)
+        mag = torch.linalg.vector_norm(flow, dim=-1).clamp(max=MAX_FLOW)
         mag = mag.view(mag.shape[1], -1)
         val = val.view(val.shape[1], -1)
 
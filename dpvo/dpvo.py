@@ -217,7 +217,7 @@ class DPVO:
             net, (delta, weight, _) = \
                 self.network.update(net, ctx, corr, None, ii, jj, kk)
 
-        return torch.quantile(delta.norm(dim=-1).float(), 0.5)
+        return torch.quantile(torch.linalg.vector_norm(delta, dim=-1).float(), 0.5)
 
     def motionmag(self, i, j):
         k = (self.ii == i) & (self.jj == j)
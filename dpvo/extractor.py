@@ -194,7 +194,7 @@ class BasicEncoder(nn.Module):
         x = self.conv2(x)
 
         _, c2, h2, w2 = x.shape
-        return x.view(b, n, c2, h2, w2)
+        return x.contiguous().view(b, n, c2, h2, w2)
 
 
 class BasicEncoder4(nn.Module):
@@ -261,4 +261,4 @@ class BasicEncoder4(nn.Module):
         x = self.conv2(x)
 
         _, c2, h2, w2 = x.shape
-        return x.view(b, n, c2, h2, w2)
+        return x.contiguous().view(b, n, c2, h2, w2)
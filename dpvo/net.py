@@ -112,6 +112,10 @@ class Patchifier(nn.Module):
         fmap = self.fnet(images) / 4.0
         imap = self.inet(images) / 4.0
 
+        # the altcorr kernels have no bfloat16 dispatch
+        if fmap.dtype == torch.bfloat16:
+            fmap, imap = fmap.float(), imap.float()
+
         b, n, c, h, w = fmap.shape
         P = self.patch_size
 
@@ -182,14 +186,15 @@ class VONet(nn.Module):
 
 
     @autocast(enabled=False)
-    def forward(self, images, poses, disps, intrinsics, M=1024, STEPS=12, P=1, structure_only=False, rescale=False):
-        """ Estimates SE3 or Sim3 between pair of frames """
+    def forward(self, images, poses, disps, intrinsics, M=1024, STEPS=12, P=1, structure_only=False, rescale=False, mixed_precision=False):
+        """ Estimates SE3 or Sim3 between pair of frames, geometry always runs in fp32 """
 
         images = 2 * (images / 255.0) - 0.5
         intrinsics = intrinsics / 4.0
         disps = disps[:, :, 1::4, 1::4].float()
 
-        fmap, gmap, imap, patches, ix = self.patchify(images, disps=disps)
+        with autocast(enabled=mixed_precision, dtype=torch.bfloat16):
+            fmap, gmap, imap, patches, ix = self.patchify(images, disps=disps)
 
         corr_fn = CorrBlock(fmap, gmap)
 
@@ -202,7 +207,7 @@ class VONet(nn.Module):
         d = patches[..., 2, p//2, p//2]
         patches = set_depth(patches, torch.rand_like(d))
 
-        kk, jj = flatmeshgrid(torch.where(ix < 8)[0], torch.arange(0,8, device="cuda"))
+        kk, jj = flatmeshgrid(torch.where(ix < 8)[0], torch.arange(0,8, device="cuda"), indexing='ij')
         ii = ix[kk]
 
         imap = imap.view(b, -1, DIM)
@@ -223,8 +228,8 @@ class VONet(nn.Module):
             n = ii.max() + 1
             if len(traj) >= 8 and n < images.shape[1]:
                 if not structure_only: Gs.data[:,n] = Gs.data[:,n-1]
-                kk1, jj1 = flatmeshgrid(torch.where(ix  < n)[0], torch.arange(n, n+1, device="cuda"))
-                kk2, jj2 = flatmeshgrid(torch.where(ix == n)[0], torch.arange(0, n+1, device="cuda"))
+                kk1, jj1 = flatmeshgrid(torch.where(ix  < n)[0], torch.arange(n, n+1, device="cuda"), indexing='ij')
+                kk2, jj2 = flatmeshgrid(torch.where(ix == n)[0], torch.arange(0, n+1, device="cuda"), indexing='ij')
 
                 ii = torch.cat([ix[kk1], ix[kk2], ii])
                 jj = torch.cat([jj1, jj2, jj])
@@ -247,7 +252,10 @@ class VONet(nn.Module):
             coords1 = coords.permute(0, 1, 4, 2, 3).contiguous()
 
             corr = corr_fn(kk, jj, coords1)
-            net, (delta, weight, _) = self.update(net, imap[:,kk], corr, None, ii, jj, kk)
+            with autocast(enabled=mixed_precision, dtype=torch.bfloat16):
+                net, (delta, weight, _) = self.update(net, imap[:,kk], corr, None, ii, jj, kk)
+
+            net, delta, weight = net.float(), delta.float(), weight.float()
 
             lmbda = 1e-4
             target = coords[...,p//2,p//2,:] + delta
@@ -1,3 +1,6 @@
+import functools
+import os
+
 import torch
 import torch.nn.functional as F
 
@@ -5,25 +8,60 @@ from .lietorch import SE3, Sim3
 
 MIN_DEPTH = 0.2
 
+# torch.compile the projection ops, off by default to avoid compile latency at inference
+COMPILE = os.environ.get("DPVO_COMPILE", "0") == "1"
+
 def extract_intrinsics(intrinsics):
+    """ split intrinsics into (fx, fy, cx, cy), each shaped [..., 1, 1] """
     return intrinsics[...,None,None,:].unbind(dim=-1)
 
-def coords_grid(ht, wd, **kwargs):
-    y, x = torch.meshgrid(
-        torch.arange(ht).to(**kwargs).float(),
-        torch.arange(wd).to(**kwargs).float())
+@functools.lru_cache(maxsize=8)
+def _coords_cache(ht, wd, device_str, dtype):
+    """ cached (x, y) pixel grid, do not modify in-place """
+    x, y = torch.meshgrid(
+        torch.arange(wd, device=device_str, dtype=dtype),
+        torch.arange(ht, device=device_str, dtype=dtype), indexing='xy')
 
     return torch.stack([x, y], dim=-1)
 
+def coords_grid(ht, wd, device="cpu", dtype=torch.float):
+    return _coords_cache(ht, wd, str(device), dtype).clone()
+
+@functools.lru_cache(maxsize=8)
+def _const_cache(values, device_str, dtype):
+    """ cached constant tensor, avoids a host -> device copy per call, do not modify in-place """
+    return torch.as_tensor(values, device=device_str, dtype=dtype)
+
+# unit quaternion (x, y, z, w) and the pose used for ii == jj in projective_transform
+QUAT_IDENTITY = (0.0, 0.0, 0.0, 1.0)
+SE3_SELF = (-0.1, 0.0, 0.0, 0.0, 0.0, 0.0, 1.0)
+
+def _fuse(fn):
+    """ fuse elementwise projection ops into a single kernel when COMPILE is set (torch >= 2.0) """
+    compiled = None
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        nonlocal compiled
+        if not (COMPILE and hasattr(torch, "compile")):
+            return fn(*args, **kwargs)
+
+        if compiled is None:
+            compiled = torch.compile(fn, dynamic=True)
 
-def iproj(patches, intrinsics):
-    """ inverse projection """
+        return compiled(*args, **kwargs)
+
+    return wrapper
+
+
+@_fuse
+def iproj(patches, fx, fy, cx, cy):
+    """ inverse projection, intrinsics split by extract_intrinsics """
     x, y, d = patches.unbind(dim=2)
-    fx, fy, cx, cy = intrinsics[...,None,None].unbind(dim=2)
 
     i = torch.ones_like(d)
-    xn = (x - cx) / fx
-    yn = (y - cy) / fy
+    xn = torch.addcmul(-cx / fx, x, 1.0 / fx)
+    yn = torch.addcmul(-cy / fy, y, 1.0 / fy)
 
     X = torch.stack([xn, yn, i, d], dim=-1)
     return X
@@ -33,30 +71,28 @@ def iproj_disps(disps, intrinsics):
     ht, wd = disps.shape[2:]
     fx, fy, cx, cy = extract_intrinsics(intrinsics)
 
-    y, x = torch.meshgrid(
-        torch.arange(ht).to(disps.device).float(),
-        torch.arange(wd).to(disps.device).float())
+    x, y = _coords_cache(ht, wd, str(disps.device), torch.float).unbind(dim=-1)
 
     i = torch.ones_like(disps)
-    X = (x - cx) / fx
-    Y = (y - cy) / fy
+    X = torch.addcmul(-cx / fx, x, 1.0 / fx)
+    Y = torch.addcmul(-cy / fy, y, 1.0 / fy)
     pts = torch.stack([X, Y, i, disps], dim=-1)
 
     return pts
 
 
-def proj(X, intrinsics, depth=False):
-    """ projection """
+@_fuse
+def proj(X, fx, fy, cx, cy, depth=False):
+    """ projection, intrinsics split by extract_intrinsics """
 
     X, Y, Z, W = X.unbind(dim=-1)
-    fx, fy, cx, cy = intrinsics[...,None,None].unbind(dim=2)
 
     # d = 0.01 * torch.ones_like(Z)
     # d[Z > 0.01] = 1.0 / Z[Z > 0.01]
     # d = torch.ones_like(Z)
     # d[Z.abs() > 0.1] = 1.0 / Z[Z.abs() > 0.1]
 
-    d = 1.0 / Z.clamp(min=0.1)
+    d = Z.clamp(min=0.1).reciprocal()
     x = fx * (d * X) + cx
     y = fy * (d * Y) + cy
 
@@ -66,13 +102,13 @@ def proj(X, intrinsics, depth=False):
     return torch.stack([x, y], dim=-1)
 
 
+@_fuse
 def proj_disps(Xs, intrinsics, jacobian=False, return_depth=False):
     """ pinhole camera projection """
     fx, fy, cx, cy = extract_intrinsics(intrinsics)
     X, Y, Z, D = Xs.unbind(dim=-1)
 
-    Z = torch.where(Z < 0.5*MIN_DEPTH, torch.ones_like(Z), Z)
-    d = 1.0 / Z
+    d = torch.where(Z < 0.5*MIN_DEPTH, torch.ones_like(Z), Z).reciprocal()
 
     x = fx * (X * d) + cx
     y = fy * (Y * d) + cy
@@ -97,43 +133,63 @@ def proj_disps(Xs, intrinsics, jacobian=False, return_depth=False):
 def transform(poses, patches, intrinsics, ii, jj, kk, depth=False, valid=False, jacobian=False, tonly=False):
     """ projective transform """
 
-    # backproject
-    X0 = iproj(patches[:,kk], intrinsics[:,ii])
+    X0, Gij, _, intrinsics_j = transform_prepare(poses, patches, intrinsics, ii, jj, kk)
+    return transform_apply(X0, Gij, intrinsics_j, depth, valid, jacobian, tonly)
 
-    # transform
+def transform_prepare(poses, patches, intrinsics, ii, jj, kk):
+    """ gather and backproject once, for several transforms over the same edges """
+
+    intrinsics_i = intrinsics[:,ii]
+    intrinsics_j = intrinsics[:,jj]
+
+    # backproject
+    X0 = iproj(patches[:,kk], *extract_intrinsics(intrinsics_i))
     Gij = poses[:, jj] * poses[:, ii].inv()
 
+    return X0, Gij, intrinsics_i, intrinsics_j
+
+def transform_apply(X0, Gij, intrinsics_j, depth=False, valid=False, jacobian=False, tonly=False):
+    """ transform backprojected points X0 by Gij and project with (gathered) intrinsics_j """
+
+    # transform
     if tonly:
-        Gij[...,3:] = torch.as_tensor([0,0,0,1], device=Gij.device)
+        Gij = SE3(Gij.data.clone())
+        Gij[...,3:] = _const_cache(QUAT_IDENTITY, str(Gij.device), Gij.dtype)
 
     X1 = Gij[:,:,None,None] * X0
 
     # project
-    x1 = proj(X1, intrinsics[:,jj], depth)
+    x1 = proj(X1, *extract_intrinsics(intrinsics_j), depth=depth)
 
 
     if jacobian:
         p = X1.shape[2]
         X, Y, Z, H = X1[...,p//2,p//2,:].unbind(dim=-1)
-        o = torch.zeros_like(H)
-        i = torch.zeros_like(H)
-
-        fx, fy, cx, cy = intrinsics[:,jj].unbind(dim=-1)
-
-        d = torch.zeros_like(Z)
-        d[Z.abs() > 0.2] = 1.0 / Z[Z.abs() > 0.2]
-
-        Ja = torch.stack([
-            H,  o,  o,  o,  Z, -Y,
-            o,  H,  o, -Z,  o,  X,
-            o,  o,  H,  Y, -X,  o,
-            o,  o,  o,  o,  o,  o,
-        ], dim=-1).view(1, len(ii), 4, 6)
 
-        Jp = torch.stack([
-             fx*d,     o, -fx*X*d*d,  o,
-                o,  fy*d, -fy*Y*d*d,  o,
-        ], dim=-1).view(1, len(ii), 2, 4)
+        fx, fy, cx, cy = intrinsics_j.unbind(dim=-1)
+
+        # masked reciprocal, the inner where keeps gradients finite
+        m = Z.abs() > 0.2
+        d = torch.where(m, 1.0 / torch.where(m, Z, torch.ones_like(Z)), torch.zeros_like(Z))
+
+        # fill only the nonzero entries of the (4 x 6) action jacobian
+        Ja = X.new_zeros(X.shape + (4, 6))
+        Ja[...,0,0] =  H
+        Ja[...,1,1] =  H
+        Ja[...,2,2] =  H
+        Ja[...,0,4] =  Z
+        Ja[...,0,5] = -Y
+        Ja[...,1,3] = -Z
+        Ja[...,1,5] =  X
+        Ja[...,2,3] =  Y
+        Ja[...,2,4] = -X
+
+        # and of the (2 x 4) projection jacobian
+        Jp = X.new_zeros(X.shape + (2, 4))
+        Jp[...,0,0] =  fx*d
+        Jp[...,0,2] = -fx*X*d*d
+        Jp[...,1,1] =  fy*d
+        Jp[...,1,2] = -fy*Y*d*d
 
         Jj = torch.matmul(Jp, Ja)
         Ji = -Gij[:,:,None].adjT(Jj)
@@ -149,36 +205,49 @@ def transform(poses, patches, intrinsics, ii, jj, kk, depth=False, valid=False,
 
 def point_cloud(poses, patches, intrinsics, ix):
     """ generate point cloud from patches """
-    return poses[:,ix,None,None].inv() * iproj(patches, intrinsics[:,ix])
+    return poses[:,ix,None,None].inv() * iproj(patches, *extract_intrinsics(intrinsics[:,ix]))
 
 
 def flow_mag(poses, patches, intrinsics, ii, jj, kk, beta=0.3):
     """ projective transform """
 
-    coords0 = transform(poses, patches, intrinsics, ii, ii, kk)
-    coords1 = transform(poses, patches, intrinsics, ii, jj, kk, tonly=False)
-    coords2 = transform(poses, patches, intrinsics, ii, jj, kk, tonly=True)
+    # gather and backproject once, shared by all three configurations
+    X0, Gij, intrinsics_i, intrinsics_j = transform_prepare(poses, patches, intrinsics, ii, jj, kk)
+
+    # full and translation-only transforms, stacked on a new dim that broadcasts against X0
+    Gt = Gij.data.clone()
+    Gt[...,3:] = _const_cache(QUAT_IDENTITY, str(Gt.device), Gt.dtype)
+    G = SE3(torch.stack([Gij.data, Gt], dim=1))
+
+    # ii -> ii is the identity, so X0 is projected directly
+    coords0 = proj(X0, *extract_intrinsics(intrinsics_i))
 
-    flow1 = (coords1 - coords0).norm(dim=-1)
-    flow2 = (coords2 - coords0).norm(dim=-1)
+    # lietorch broadcasting still materialises X0 (2x) and G (P*P x) before the action
+    X1 = G[:,:,:,None,None] * X0[:,None]
+    coords1, coords2 = proj(X1, *extract_intrinsics(intrinsics_j[:,None])).unbind(dim=1)
+
+    flow1 = torch.linalg.vector_norm(coords1 - coords0, dim=-1)
+    flow2 = torch.linalg.vector_norm(coords2 - coords0, dim=-1)
 
     return beta * flow1 + (1-beta) * flow2
 
 
-def projective_transform(poses, depths, intrinsics, ii, jj):
-    """ map points from ii->jj """
+def projective_transform(poses, depths, intrinsics, ii, jj, Gij=None):
+    """ map points from ii->jj, Gij can be passed in if already computed """
 
     # inverse project (pinhole)
     X0 = iproj_disps(depths[:,ii], intrinsics[:,ii])
 
-    # transform
-    Gij = poses[:,jj] * poses[:,ii].inv()
+    # transform, without writing into a caller-provided Gij
+    if Gij is None:
+        Gij = poses[:,jj] * poses[:,ii].inv()
 
-    Gij.data[:,ii==jj] = torch.as_tensor([-0.1, 0.0, 0.0, 0.0, 0.0, 0.0, 1.0], device=torch.device('cuda'))
+    Gii = _const_cache(SE3_SELF, str(Gij.device), Gij.dtype)
+    Gij = SE3(torch.where((ii==jj).to(Gij.device)[:,None], Gii, Gij.data))
     X1 = Gij[:,:,None,None] * X0
 
     # project (pinhole)
-    x1 = proj(X1, intrinsics[:,jj])
+    x1 = proj(X1, *extract_intrinsics(intrinsics[:,jj]))
 
     # exclude points too close to camera
     valid = ((X1[...,2] > MIN_DEPTH) & (X0[...,2] > MIN_DEPTH)).float()
@@ -187,15 +256,11 @@ def projective_transform(poses, depths, intrinsics, ii, jj):
     return x1, valid
 
 
-def induced_flow(poses, disps, intrinsics, ii, jj):
+def induced_flow(poses, disps, intrinsics, ii, jj, Gij=None):
     """ optical flow induced by camera motion """
 
     ht, wd = disps.shape[2:]
-    y, x = torch.meshgrid(
-        torch.arange(ht).to(disps.device).float(),
-        torch.arange(wd).to(disps.device).float())
-
-    coords0 = torch.stack([x, y], dim=-1)
-    coords1, valid = projective_transform(poses, disps, intrinsics, ii, jj)
+    coords0 = _coords_cache(ht, wd, str(disps.device), torch.float)
+    coords1, valid = projective_transform(poses, disps, intrinsics, ii, jj, Gij)
 
     return coords1[...,:2] - coords0, valid
@@ -73,7 +73,7 @@ def pyramidify(fmap, lvls=[1]):
     return pyramid
 
 def all_pairs_exclusive(n, **kwargs):
-    ii, jj = torch.meshgrid(torch.arange(n, **kwargs), torch.arange(n, **kwargs))
+    ii, jj = torch.meshgrid(torch.arange(n, **kwargs), torch.arange(n, **kwargs), indexing="ij")
     k = ii != jj
     return ii[k].reshape(-1), jj[k].reshape(-1)
 
@@ -3,6 +3,14 @@ import argparse
 from collections import OrderedDict
 
 import torch
+
+# grow cached segments instead of emptying the cache between train / validation, the
+# allocator reads this on first cuda use and only torch >= 2.1 accepts the option
+if torch.__version__ >= "2.1":
+    os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True")
+
+EXPANDABLE_SEGMENTS = "expandable_segments:True" in os.environ.get("PYTORCH_CUDA_ALLOC_CONF", "")
+
 from torch.utils.data import DataLoader
 from lightning.fabric import Fabric
 
@@ -12,7 +20,9 @@ from dpvo.data_readers.factory import dataset_factory
 from dpvo.lietorch import SE3
 from dpvo.logger import Logger
 
+from dpvo import projective_ops as pops
 from dpvo.net import VONet
+from dpvo.utils import all_pairs_exclusive
 from evaluate_tartan import evaluate as validate
 
 
@@ -20,15 +30,44 @@ def kabsch_umeyama(A, B):
     n, m = A.shape
     EA = torch.mean(A, axis=0)
     EB = torch.mean(B, axis=0)
-    VarA = torch.mean((A - EA).norm(dim=1) ** 2)
+    VarA = (A - EA).pow(2).sum(dim=1).mean()
 
     H = ((A - EA).T @ (B - EB)) / n
-    U, D, VT = torch.svd(H)
+    D = torch.linalg.svdvals(H)
 
-    c = VarA / torch.trace(torch.diag(D))
+    c = VarA / D.sum()
     return c
 
 
+def compute_loss_entry(v, x, y, e1, P, flow_weight, pose_weight, use_pose):
+    """flow and pose loss of one trajectory entry, lietorch ops stay with the caller"""
+    m = (v > 0.5).reshape(-1)
+
+    # masked mean over valid patches keeps shapes static for torch.compile
+    e = torch.linalg.vector_norm(x - y, dim=-1).reshape(-1, P**2).min(dim=-1).values
+    loss = flow_weight * torch.where(m, e, torch.zeros_like(e)).sum() / m.sum()
+
+    tr = torch.linalg.vector_norm(e1[..., 0:3], dim=-1)
+    ro = torch.linalg.vector_norm(e1[..., 3:6], dim=-1)
+
+    if use_pose:
+        loss = loss + pose_weight * (tr.mean() + ro.mean())
+
+    return loss, e, m, tr, ro
+
+
+def compile_network(net):
+    """compile the pure-tensor submodules of VONet in place, keeping state_dict keys"""
+    if not hasattr(torch.nn.Module, "compile"):
+        return
+
+    # encoders see a fixed image size, update MLPs a varying number of edges
+    net.patchify.fnet.compile(mode="max-autotune-no-cudagraphs", dynamic=False)
+    net.patchify.inet.compile(mode="max-autotune-no-cudagraphs", dynamic=False)
+    net.update.corr.compile(dynamic=True)
+    net.update.gru.compile(dynamic=True)
+
+
 def setup_ddp(gpu, args):
     os.environ["MASTER_ADDR"] = "127.0.0.1"
     os.environ["MASTER_PORT"] = "12355"
@@ -44,7 +83,15 @@ def train(fabric, args):
 
     print(f"args.datapath: {args.datapath}")
     db = dataset_factory(["tartan"], datapath=args.datapath, n_frames=args.n_frames)
-    train_loader = DataLoader(db, batch_size=1, shuffle=True, num_workers=2)
+    train_loader = DataLoader(
+        db,
+        batch_size=1,
+        shuffle=True,
+        num_workers=2,
+        pin_memory=True,
+        persistent_workers=True,
+        prefetch_factor=4,
+    )
     net = VONet()
 
     if args.ckpt is not None:
@@ -55,6 +102,18 @@ def train(fabric, args):
         #     new_state_dict[k.replace("module.", "")] = v
         # net.load_state_dict(new_state_dict, strict=False)
 
+    # channels_last conv weights route the context encoder to NHWC kernels; fnet is left NCHW
+    # since instance_norm makes its input contiguous, which would add two layout copies per norm
+    net.patchify.inet.to(memory_format=torch.channels_last)
+
+    loss_entry = compute_loss_entry
+    if args.compile:
+        compile_network(net)
+        pops.COMPILE = True
+
+        if hasattr(torch, "compile"):
+            loss_entry = torch.compile(compute_loss_entry, dynamic=True)
+
     optimizer = torch.optim.AdamW(net.parameters(), lr=args.lr, weight_decay=1e-6)
 
     scheduler = torch.optim.lr_scheduler.OneCycleLR(
@@ -73,9 +132,16 @@ def train(fabric, args):
     total_steps = 0
     should_keep_training = True
 
+    # (ii, jj) index pairs for the pose loss, keyed by number of frames
+    pairs = {}
+
     while should_keep_training:
         for data_blob in train_loader:
-            images, poses, disps, intrinsics = [x.cuda().float() for x in data_blob]
+            # no-op casts when the dataset already yields float32
+            images, poses, disps, intrinsics = [
+                x.to("cuda", dtype=torch.float32, non_blocking=True)
+                for x in data_blob
+            ]
             optimizer.zero_grad()
 
             # fix poses to gt for first 1k steps
@@ -83,22 +149,23 @@ def train(fabric, args):
 
             poses = SE3(poses).inv()
             traj = net(
-                images, poses, disps, intrinsics, M=1024, STEPS=18, structure_only=so
+                images,
+                poses,
+                disps,
+                intrinsics,
+                M=1024,
+                STEPS=18,
+                structure_only=so,
+                mixed_precision=args.mixed_precision,
             )
 
             loss = 0.0
             for i, (v, x, y, P1, P2, kl) in enumerate(traj):
-                e = (x - y).norm(dim=-1)
-                e = e.reshape(-1, net.P**2)[(v > 0.5).reshape(-1)].min(dim=-1).values
-
                 N = P1.shape[1]
-                ii, jj = torch.meshgrid(torch.arange(N), torch.arange(N))
-                ii = ii.reshape(-1).cuda()
-                jj = jj.reshape(-1).cuda()
+                if N not in pairs:
+                    pairs[N] = all_pairs_exclusive(N, device="cuda")
 
-                k = ii != jj
-                ii = ii[k]
-                jj = jj[k]
+                ii, jj = pairs[N]
 
                 P1 = P1.inv()
                 P2 = P2.inv()
@@ -109,16 +176,22 @@ def train(fabric, args):
                 s = kabsch_umeyama(t2[0], t1[0]).detach().clamp(max=10.0)
                 P1 = P1.scale(s.view(1, 1))
 
-                dP = P1[:, ii].inv() * P1[:, jj]
-                dG = P2[:, ii].inv() * P2[:, jj]
-
-                e1 = (dP * dG.inv()).log()
-                tr = e1[..., 0:3].norm(dim=-1)
-                ro = e1[..., 3:6].norm(dim=-1)
-
-                loss += args.flow_weight * e.mean()
-                if not so and i >= 2:
-                    loss += args.pose_weight * (tr.mean() + ro.mean())
+                # dP * dG.inv() = P1[ii].inv() * (P1 * P2.inv())[jj] * P2[ii],
+                # compose per frame first so only two products run per pair
+                D = P1 * P2.inv()
+                e1 = (P1.inv()[:, ii] * D[:, jj] * P2[:, ii]).log()
+
+                loss_i, e, m, tr, ro = loss_entry(
+                    v,
+                    x,
+                    y,
+                    e1,
+                    net.P,
+                    args.flow_weight,
+                    args.pose_weight,
+                    not so and i >= 2,
+                )
+                loss += loss_i
 
             # kl is 0 (not longer used)
             loss += kl
@@ -133,7 +206,7 @@ def train(fabric, args):
             metrics = {
                 "loss": loss.item(),
                 "kl": kl.item(),
-                "px1": (e < 0.25).float().mean().item(),
+                "px1": (((e < 0.25) & m).sum() / m.sum()).item(),
                 "ro": ro.float().mean().item(),
                 "tr": tr.float().mean().item(),
                 "r1": (ro < 0.001).float().mean().item(),
@@ -145,15 +218,23 @@ def train(fabric, args):
             logger.push(metrics)
 
             if total_steps % 10000 == 0:
-                torch.cuda.empty_cache()
+                if not EXPANDABLE_SEGMENTS:
+                    torch.cuda.empty_cache()
 
                 PATH = "checkpoints/%s_%06d.pth" % (args.name, total_steps)
                 torch.save(net.state_dict(), PATH)
 
-                validation_results = validate(None, net)
+                # real-time validation runs the eager projection ops, as in inference
+                compile_ops, pops.COMPILE = pops.COMPILE, False
+                try:
+                    validation_results = validate(None, net)
+                finally:
+                    pops.COMPILE = compile_ops
                 logger.write_dict(validation_results)
 
-                torch.cuda.empty_cache()
+                if not EXPANDABLE_SEGMENTS:
+                    torch.cuda.empty_cache()
+
                 net.train()
 
             if total_steps >= args.steps:
@@ -177,13 +258,33 @@ if __name__ == "__main__":
         default="/home/akashsharma/workspace/datasets/TartanAir",
     )
     parser.add_argument("--gpus", type=int, default=2)
+    parser.add_argument(
+        "--mixed_precision",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="run the network (not the geometry) in bf16 autocast, if the gpu supports it",
+    )
+    parser.add_argument(
+        "--compile",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="torch.compile the encoders, update MLPs, loss and projection ops",
+    )
 
     if not os.path.isdir("checkpoints"):
         os.mkdir("checkpoints")
 
     args = parser.parse_args()
+
+    # bf16 autocast raises on gpus without bf16 support (pre-Ampere)
+    if args.mixed_precision and not (torch.cuda.is_available() and torch.cuda.is_bf16_supported()):
+        print("bf16 is not supported on this device, disabling mixed precision")
+        args.mixed_precision = False
+
     print(args)
     torch.set_float32_matmul_precision("medium")
+    torch.backends.cudnn.allow_tf32 = True
+    torch.backends.cudnn.benchmark = True
     fabric = Fabric(accelerator="auto", strategy="ddp")
     fabric.launch()
     train(fabric, args)